@@ -5,22 +5,33 @@ This script simulates a library system where books can be borrowed and returned.
 The simulation runs through multiple days, tracking book transactions and providing daily summaries.
 
 Dependencies:
+- numpy
 - pandas
 
 Usage:
 Run the script to start the library simulation. The simulation will iterate through days, simulating book borrowing, returns, and providing daily summaries.
 
 """
-from collections import Counter
+from collections import Counter, defaultdict
+import hashlib
+import heapq
+import itertools
+import os
 import random
+import sys
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 
+import numpy as np
 import pandas as pd
 
 
 DB_FILENAME: str = "book_db.csv"
-DEFAULT_DATE: datetime = datetime(1970, 1, 1, 1, 1)
+COPIES_FILENAME: str = "copies.bin"
+# Size of the book database digest stored at the start of the copies file.
+COPIES_HEADER_SIZE: int = hashlib.sha256().digest_size
+MINUTES_PER_DAY: int = 24 * 60
+DEFAULT_RETURN_MIN: int = -1
 
 
 def action(func: callable):
@@ -52,7 +63,7 @@ class Book:
     Attributes:
         title (str): The title of the book.
         author (str): The author of the book.
-        return_time (datetime): The expected return time of the book.
+        book_id (int): The position of the book in the library, used to look up its return time.
         returned (bool): A flag indicating if the book has been returned.
         borrowed (bool): A flag indicating if the book is currently borrowed.
 
@@ -60,9 +71,11 @@ class Book:
         __init__: Initializes a Book object.
     """
 
+    __slots__ = ("title", "author", "book_id", "returned", "borrowed")
+
     title: str
     author: str
-    return_time: datetime
+    book_id: int
     returned: bool
     borrowed: bool
 
@@ -70,13 +83,13 @@ class Book:
         self,
         title: str,
         author: str,
-        return_time: datetime = DEFAULT_DATE,
+        book_id: int,
         returned: bool = False,
         borrowed: bool = False,
     ):
         self.title = title
         self.author = author
-        self.return_time = return_time
+        self.book_id = book_id
         self.returned = returned
         self.borrowed = borrowed
 
@@ -88,6 +101,10 @@ class ChancesAndTime:
     Attributes:
         start_time (datetime): The starting time of the library operation.
         end_time (datetime): The ending time of the library operation.
+        start_minute (int): The minute of the day at which the library opens.
+        day_minutes (int): The number of minutes the library is open each day.
+        verbose (bool): Whether prefixed messages are printed at all.
+        _msg_buf (list[str]): Prefixed messages waiting to be written by flush_prints.
 
     Methods:
         __init__: Initializes a ChancesAndTime object.
@@ -95,14 +112,22 @@ class ChancesAndTime:
         borrow_diceroll: Simulates a dice roll for book borrowings.
         random_book: Randomly selects a book from the provided list.
         random_return_time: Generates a random return time for a borrowed book.
-        date_up_to_minutes: Returns a new datetime object up to minutes precision.
-        prefixed_print: Prints a formatted message with a day count and time.
+        clock: Formats a simulated minute as the time of day.
+        prefixed_print: Buffers a book message with a day count and time, formatted only when verbose.
+        flush_prints: Writes the buffered messages to stdout at once.
     """
 
     start_time: datetime
     end_time: datetime
+    start_minute: int
+    day_minutes: int
+    verbose: bool
+    _msg_buf: list[str]
+
+    def __init__(self, verbose: bool = True):
+        self.verbose = verbose
+        self._msg_buf = []
 
-    def __init__(self):
         current_time = datetime.now()
         self.start_time = datetime(
             current_time.year, current_time.month, current_time.day, 10, 0
@@ -111,56 +136,43 @@ class ChancesAndTime:
             current_time.year, current_time.month, current_time.day, 20, 0
         )  # End time at 20:00 PM
 
+        # The simulation clock counts whole minutes from the opening time.
+        self.start_minute = self.start_time.hour * 60 + self.start_time.minute
+        self.day_minutes = int((self.end_time - self.start_time).total_seconds() // 60)
+
     def return_diceroll(self) -> bool:
         # 95% chance to return a book
-        diceroll = random.randint(1, 100)
-        if diceroll > 5:
-            return True
-
-        return False
+        return random.random() >= 0.05
 
     def borrow_diceroll(self) -> bool:
         # 50% chance to borrow a book
-        diceroll = random.randint(1, 2)
-        if diceroll > 1:
-            return True
-
-        return False
+        return random.getrandbits(1) == 1
 
     def random_book(self, books: list) -> Book:
-        book_index = random.randint(0, len(books) - 1)
-        return books[book_index]
+        return random.choice(books)
 
-    def random_return_time(self, simulation_current_time: datetime) -> datetime:
+    def random_return_time(self, current_min: int) -> int:
         # Calculate the time difference in minutes.
-        time_difference = (
-            self.end_time - simulation_current_time
-        ).total_seconds() // 60
+        time_difference = self.day_minutes - current_min
 
         # Generate a random return time using the minute time difference.
-        return_time = simulation_current_time + timedelta(
-            minutes=round(random.randint(0, time_difference))
-        )
+        return current_min + random.randint(0, time_difference)
 
-        return datetime(
-            year=return_time.year,
-            month=return_time.month,
-            day=return_time.day,
-            hour=return_time.hour,
-            minute=return_time.minute,
-        )
+    def clock(self, current_min: int) -> str:
+        hours, minutes = divmod(self.start_minute + current_min, 60)
+        return f"{hours:02d}:{minutes:02d}"
 
-    def date_up_to_minutes(self, input_datetime: datetime) -> datetime:
-        return datetime(
-            year=input_datetime.year,
-            month=input_datetime.month,
-            day=input_datetime.day,
-            hour=input_datetime.hour,
-            minute=input_datetime.minute,
-        )
+    def prefixed_print(self, day_count: int, current_min: int, txt: str, title: str):
+        # txt is a template for the title, so nothing is formatted when quiet.
+        if self.verbose:
+            self._msg_buf.append(
+                f"Day {day_count} {self.clock(current_min)}: {txt.format(title)}\n"
+            )
 
-    def prefixed_print(self, day_count: int, time: str, txt: str):
-        print(f"Day {day_count} {time}: {txt}")
+    def flush_prints(self):
+        if self._msg_buf:
+            sys.stdout.write("".join(self._msg_buf))
+            self._msg_buf.clear()
 
 
 class Library:
@@ -168,21 +180,30 @@ class Library:
     Class representing the library and its operations.
 
     Attributes:
-        book_db (pd.DataFrame): The database of books.
-        filter (list): List of allowed filter attributes for book queries.
+        book_db (pd.DataFrame): The database of books, only used for loading.
+        copies (np.memmap): Available copies per database row, memory-mapped from the copies file.
+        _title_idx (dict[str, int]): Row position of each title in the database.
+        meta (dict[str, dict]): Title, author and publication year of each book, keyed by title.
+        by_author (dict[str, list[str]]): Titles written by each author.
+        by_year (dict[int, list[str]]): Titles published in each year.
         books (list[Book]): List of Book objects representing available copies in the library.
+        return_times (np.ndarray): Expected return minute of each book, indexed by book_id.
+        events (list[tuple[int, int, Book]]): Min-heap of scheduled book returns.
 
     Methods:
         __init__: Initializes a Library object.
 
-        _get_book: Retrieves books from the database based on search criteria.
         _init_book_db: Initializes the book database.
-        _init_filter: Initializes the filter attribute.
+        _init_lookups: Builds the in-memory lookups from the book database.
         _init_books: Initializes the list of available books.
         _load_book_db: Loads the book database from a CSV file.
+        _load_copies: Maps the available copies file, creating it from the database if needed.
         _is_book_borrowable: Checks if a book is available for borrowing.
-        _remove_book_copy: Decreases the available copies of a book.
-        _add_book_copy: Increases the available copies of a book.
+        _remove_book_copy: Decreases the available copies of a book and returns the new count.
+        _add_book_copy: Increases the available copies of a book and returns the new count.
+        flush_db: Writes the available copies back to the copies file.
+        schedule_return: Schedules the return of a borrowed book.
+        pop_due_returns: Retrieves the books whose return is due by the given time.
 
         borrow_book: Borrows a book from the library.
         return_book: Returns a borrowed book to the library.
@@ -190,93 +211,169 @@ class Library:
         get_books_by_author: Retrieves books written by a specific author.
         get_books_by_publication_year: Retrieves books published in a specific year.
         another_chance_to_return: Adjusts the return time for books for the next day.
-        process_row: Processes a row from the book database and adds book copies to the library.
     """
 
     book_db: pd.DataFrame
-    filter: list
+    copies: np.memmap
+    _title_idx: dict[str, int]
+    meta: dict[str, dict]
+    by_author: dict[str, list[str]]
+    by_year: dict[int, list[str]]
     books: list[Book]
+    return_times: np.ndarray
+    events: list[tuple[int, int, Book]]
 
     def __init__(self):
         self._init_book_db()
-        self._init_filter()
+        self._init_lookups()
         self._init_books()
-
-    def _get_book(self, search_for: str, search_value: tuple[str, int]) -> pd.DataFrame:
-        if search_for not in self.filter:
-            return pd.DataFrame()
-
-        return self.book_db[self.book_db[search_for] == search_value]
+        self.events = []
+        # Tie-breaker so books with the same return time are never compared.
+        self._event_seq = itertools.count()
 
     @action
     def _init_book_db(self):
         if not self._load_book_db():
             print("Couldn't load the book database.")
 
-    def _init_filter(self):
-        self.filter = (
-            "title",
-            "author",
-            "publication_year",
-        )
+        if not self._load_copies():
+            print("Couldn't load the available copies.")
 
-    def _init_books(self):
-        self.books = []
+    def _init_lookups(self):
+        self._title_idx = {}
+        self.meta = {}
+        self.by_author = defaultdict(list)
+        self.by_year = defaultdict(list)
 
-        self.book_db.apply(self.process_row, axis=1)
+        # Assuming there are no duplicate titles in the CSV.
+        for i, record in enumerate(self.book_db.to_dict("records")):
+            title = record["title"]
+            # The live count is kept in the copies file.
+            record.pop("available_copies")
+            self._title_idx[title] = i
+            self.meta[title] = record
+            self.by_author[record["author"]].append(title)
+            self.by_year[record["publication_year"]].append(title)
 
-    def process_row(self, row):
-        title = row["title"]
-        author = row["author"]
-        available_copies = row["available_copies"]
+    def _init_books(self):
+        titles = self.book_db["title"].to_numpy()
+        authors = self.book_db["author"].to_numpy()
+        counts = np.asarray(self.copies)
 
-        for _ in range(available_copies):
-            book_copy = Book(title, author)
-            self.books.append(book_copy)
+        # One row index per available copy, e.g. counts [2, 1] -> [0, 0, 1].
+        indices = np.repeat(np.arange(len(counts)), counts)
+        self.books = [
+            Book(titles[i], authors[i], book_id) for book_id, i in enumerate(indices)
+        ]
+        self.return_times = np.full(len(self.books), DEFAULT_RETURN_MIN, dtype=np.int64)
 
     @action
     def _load_book_db(self):
         self.book_db = pd.read_csv(DB_FILENAME)
 
+    @action
+    def _load_copies(self):
+        counts = self.book_db["available_copies"].to_numpy(dtype=np.int32)
+
+        # The copies are stored by row, so they are only valid for the exact
+        # database they were created from.
+        with open(DB_FILENAME, "rb") as db_file:
+            db_digest = hashlib.sha256(db_file.read()).digest()
+
+        if os.path.exists(COPIES_FILENAME):
+            with open(COPIES_FILENAME, "rb") as copies_file:
+                stored_digest = copies_file.read(COPIES_HEADER_SIZE)
+
+            if (
+                stored_digest != db_digest
+                or os.path.getsize(COPIES_FILENAME)
+                != COPIES_HEADER_SIZE + counts.nbytes
+            ):
+                print(
+                    f"{COPIES_FILENAME} doesn't match {DB_FILENAME}, "
+                    "resetting the available copies from the database."
+                )
+                os.remove(COPIES_FILENAME)
+
+        if not os.path.exists(COPIES_FILENAME):
+            with open(COPIES_FILENAME, "wb") as copies_file:
+                copies_file.write(db_digest)
+                copies_file.write(counts.tobytes())
+
+        self.copies = np.memmap(
+            COPIES_FILENAME,
+            dtype=np.int32,
+            mode="r+",
+            offset=COPIES_HEADER_SIZE,
+            shape=counts.shape,
+        )
+
     def _is_book_borrowable(self, book_title: str) -> bool:
-        book = self.get_book_by_title(book_title)
-        return True if book["available_copies"] > 0 else False
+        return self.copies[self._title_idx[book_title]] > 0
 
-    @action
-    def _remove_book_copy(self, book_title: str):
-        self.book_db.loc[self.book_db["title"] == book_title, "available_copies"] -= 1
-        self.book_db.to_csv(DB_FILENAME, index=False)
+    def _remove_book_copy(self, book_title: str) -> int:
+        row = self._title_idx[book_title]
+        self.copies[row] -= 1
+        return int(self.copies[row])
+
+    def _add_book_copy(self, book_title: str) -> int:
+        row = self._title_idx[book_title]
+        self.copies[row] += 1
+        return int(self.copies[row])
 
     @action
-    def _add_book_copy(self, book_title: str):
-        self.book_db.loc[self.book_db["title"] == book_title, "available_copies"] += 1
-        self.book_db.to_csv(DB_FILENAME, index=False)
+    def flush_db(self):
+        self.copies.flush()
 
     def borrow_book(self, book_title: str) -> bool:
         if self._is_book_borrowable(book_title):
-            return self._remove_book_copy(book_title)
+            self._remove_book_copy(book_title)
+            return True
 
         return False
 
     def return_book(self, book_title: str) -> bool:
-        return self._add_book_copy(book_title)
+        if book_title not in self._title_idx:
+            print(f"(return_book): Unknown title {book_title!r}")
+            return False
+
+        self._add_book_copy(book_title)
+        return True
 
     def get_book_by_title(self, title: str) -> dict:
-        # Assuming there are no duplicate titles in the CSV.
-        try:
-            return self._get_book("title", title).to_dict("records")[0]
-        except IndexError:
+        if title not in self.meta:
             return {}
 
+        available_copies = int(self.copies[self._title_idx[title]])
+        return {**self.meta[title], "available_copies": available_copies}
+
     def get_books_by_author(self, author: str) -> list:
-        return self._get_book("author", author).to_dict("records")
+        return [
+            self.get_book_by_title(title) for title in self.by_author.get(author, ())
+        ]
 
     def get_books_by_publication_year(self, year: int) -> list:
-        return self._get_book("publication_year", year).to_dict("records")
+        return [self.get_book_by_title(title) for title in self.by_year.get(year, ())]
+
+    def schedule_return(self, book: Book, return_min: int):
+        self.return_times[book.book_id] = return_min
+        heapq.heappush(self.events, (return_min, next(self._event_seq), book))
+
+    def pop_due_returns(self, current_min: int) -> list[Book]:
+        due_books = []
+        while self.events and self.events[0][0] <= current_min:
+            due_books.append(heapq.heappop(self.events)[2])
+
+        return due_books
 
     def another_chance_to_return(self):
-        for book in self.books:
-            book.return_time += timedelta(days=1)
+        self.return_times += MINUTES_PER_DAY
+
+        # Shifting every entry by the same amount keeps the heap ordered.
+        self.events = [
+            (return_min + MINUTES_PER_DAY, seq, book)
+            for return_min, seq, book in self.events
+        ]
 
 
 class Simulation:
@@ -289,12 +386,20 @@ class Simulation:
         current_day (int): The current day in the simulation.
         library (Library): The library object for the simulation.
         common (ChancesAndTime): The ChancesAndTime object for random events and time calculations.
+        borrow_counts (Counter): Number of times each title has been borrowed.
+        num_borrowed (int): Number of books that have been borrowed.
+        borrowed_set (set[Book]): Borrowed books that have not been returned.
+        verbose (bool): Whether the book transactions are printed, forwarded to common. Defaults to True.
+        realtime (bool): Whether to pause between simulated minutes and days so the output can be followed.
+            Defaults to False, which runs the simulation as fast as possible.
 
     Methods:
         __init__: Initializes a Simulation object.
+        verbose: Gets or sets whether the book transactions are printed.
         unreturned_books: Returns the count of books that are currently borrowed and not returned.
         most_popular_book: Returns the most borrowed book and its borrowing count.
-        simulate_day: Simulates a day of library operations, including book transactions and summaries.
+        run: Runs the simulation day after day.
+        _run_one_day: Simulates a day of library operations, including book transactions and summaries.
         daily_summary: Displays a summary of the day's library operations.
     """
 
@@ -303,53 +408,69 @@ class Simulation:
     current_day: int
     library: Library
     common: ChancesAndTime
+    borrow_counts: Counter
+    num_borrowed: int
+    borrowed_set: set[Book]
+    realtime: bool
 
-    def __init__(self):
+    def __init__(self, realtime: bool = False, verbose: bool = True):
         self.library = Library()
-        self.common = ChancesAndTime()
+        self.common = ChancesAndTime(verbose)
 
         self.current_time = self.common.start_time
         self.end_time = self.common.end_time
         self.current_day = 1
+        self.realtime = realtime
 
-    def unreturned_books(self) -> list:
-        return sum(
-            1 for book in self.library.books if not book.returned and book.borrowed
-        )
+        self.borrow_counts = Counter()
+        self.num_borrowed = 0
+        self.borrowed_set = set()
 
-    def most_popular_book(self) -> tuple:
-        return Counter(
-            book.title for book in self.library.books if book.borrowed
-        ).most_common(1)[0]
+    @property
+    def verbose(self) -> bool:
+        return self.common.verbose
 
-    def simulate_day(self):
-        current_loop_time = self.common.start_time
-        print(f"--- Starting day {self.current_day} ---")
-        while current_loop_time < self.common.end_time:
-            # Display current hour and minute
-            time_msg = current_loop_time.strftime("%H:%M")
+    @verbose.setter
+    def verbose(self, verbose: bool):
+        self.common.verbose = verbose
+
+    def unreturned_books(self) -> int:
+        return len(self.borrowed_set)
 
-            for book in self.library.books:
-                current_time_minutes = self.common.date_up_to_minutes(current_loop_time)
+    def most_popular_book(self) -> tuple:
+        return self.borrow_counts.most_common(1)[0]
 
+    def run(self):
+        while True:
+            self._run_one_day()
+
+    def _run_one_day(self):
+        current_min = 0
+        print(f"--- Starting day {self.current_day} ---")
+        while current_min < self.common.day_minutes:
+            # Only the books due by this minute need to be checked.
+            for book in self.library.pop_due_returns(current_min):
                 # Check if any books should be returned at this time.
                 if (
-                    book.return_time == current_time_minutes
+                    self.library.return_times[book.book_id] == current_min
                     and book.borrowed is True
                     and book.returned is False
                 ) and self.common.return_diceroll():
                     if self.library.return_book(book.title):
                         self.common.prefixed_print(
                             self.current_day,
-                            time_msg,
-                            f"{book.title} has been returned.",
+                            current_min,
+                            "{} has been returned.",
+                            book.title,
                         )
                         book.returned = True
+                        self.borrowed_set.discard(book)
                     else:
                         self.common.prefixed_print(
                             self.current_day,
-                            time_msg,
-                            f"The book {book.title} couldn't be returned.",
+                            current_min,
+                            "The book {} couldn't be returned.",
+                            book.title,
                         )
 
             if self.common.borrow_diceroll():
@@ -358,42 +479,54 @@ class Simulation:
                 if book.borrowed is False and self.library.borrow_book(book.title):
                     book.borrowed = True
                     book.returned = False
-                    book.return_time = self.common.random_return_time(
-                        current_time_minutes
+                    self.library.schedule_return(
+                        book, self.common.random_return_time(current_min)
                     )
 
+                    self.borrow_counts[book.title] += 1
+                    self.num_borrowed += 1
+                    self.borrowed_set.add(book)
+
                     self.common.prefixed_print(
-                        self.current_day, time_msg, f"{book.title} has been borrowed."
+                        self.current_day,
+                        current_min,
+                        "{} has been borrowed.",
+                        book.title,
                     )
                 else:
                     self.common.prefixed_print(
                         self.current_day,
-                        time_msg,
-                        f"The book {book.title} couldn't be borrowed.",
+                        current_min,
+                        "The book {} couldn't be borrowed.",
+                        book.title,
                     )
 
-            current_loop_time += timedelta(minutes=1)
-            time.sleep(0.05)
+            # Write the minute's messages in one go.
+            self.common.flush_prints()
+
+            current_min += 1
+            if self.realtime:
+                time.sleep(0.05)
 
         self.daily_summary(self.current_day)
         self.current_day += 1
-        self.simulate_day()
 
     def daily_summary(self, day: int):
         most_popular_book, times_borrowed = self.most_popular_book()
-        num_borrowed = sum(1 for book in self.library.books if book.borrowed)
         print(f"End of Day {day} summary: \n")
-        print(f"{num_borrowed} books were borrowed.")
+        print(f"{self.num_borrowed} books were borrowed.")
         print(
             f"The most popular book was: {most_popular_book}, borrowed {times_borrowed} times."
         )
 
         print(f"{self.unreturned_books()} books were not returned.")
         self.library.another_chance_to_return()
+        self.library.flush_db()
 
-        time.sleep(5)
+        if self.realtime:
+            time.sleep(5)
 
 
 if __name__ == "__main__":
-    library = Simulation()
-    library.simulate_day()
+    library = Simulation(realtime=True)
+    library.run()